@@ -1,6 +1,7 @@
 """
 FastAPI application for NeuroScan Layer 1 - Volumetric Data Server
 """
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import volumetric
@@ -28,6 +29,13 @@ from app.routers import segmentation
 app.include_router(segmentation.router, prefix="/api", tags=["segmentation"])
 
 
+@app.on_event("startup")
+async def backfill_raw_copies():
+    """Transcode pre-existing .nii.gz uploads once, without blocking startup."""
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(None, volumetric.file_storage.backfill_raw_copies)
+
+
 @app.get("/")
 async def root():
     return {"message": "NeuroScan Layer 1 API", "status": "running"}
@@ -3,13 +3,51 @@ Segmentation mask endpoints for Layer 2 integration
 """
 from fastapi import APIRouter, HTTPException, UploadFile, File
 from fastapi.responses import Response
-from typing import Optional
+from pydantic import BaseModel
+from typing import List, Optional
 from app.services.volumetric_processor import VolumetricProcessor
 from app.services.file_storage import FileStorage
+from app.services.mask_versioning import MaskVersionStore
 
 router = APIRouter()
 processor = VolumetricProcessor()
 file_storage = FileStorage()
+mask_store = MaskVersionStore()
+
+
+class BrickDelta(BaseModel):
+    """Dense edit of a box-shaped region of a mask."""
+    origin: List[int]  # [x, y, z] of the brick's first voxel
+    shape: List[int]  # [a, b, c] extent along each axis
+    labels: List[int]  # a * b * c labels in C order
+
+
+class MaskPatch(BaseModel):
+    """Sparse edits to a segmentation mask. Bricks are applied before voxels."""
+    voxels: List[List[int]] = []  # [x, y, z, label] entries; last entry wins per coordinate
+    bricks: List[BrickDelta] = []
+    base_version: Optional[int] = None  # Reject the patch if the mask has moved past this version
+
+
+def _mask_blob(mask_id: str, file_path: str) -> bytes:
+    """
+    Binary mask data for the current version, scaled by the mask's label
+    range so full downloads and replayed deltas agree.
+    """
+    if mask_id in processor.data_cache:
+        return processor.data_cache[mask_id]
+    labels, label_range = mask_store.render(mask_id, file_path)
+    return processor.process_array(labels, cache_key=mask_id, value_range=label_range)
+
+
+def _label_headers(mask_id: str, file_path: str) -> dict:
+    """Response headers describing a mask's version and label scale."""
+    label_min, label_max = mask_store.get_label_range(mask_id, file_path)
+    return {
+        "X-Mask-Version": str(mask_store.get_version(mask_id)),
+        "X-Label-Min": str(label_min),
+        "X-Label-Max": str(label_max)
+    }
 
 
 @router.post("/segmentation/upload")
@@ -58,8 +96,11 @@ async def upload_segmentation_mask(
             "base_file_id": base_file_id
         }
         
+        # Ingest: make the compressed mask memory-mappable
+        file_storage.transcode_to_raw(mask_id)
+        
         # Process mask (normalize labels to 0-1 range for visualization)
-        binary_blob = processor.process_file(str(file_path), cache_key=mask_id)
+        _mask_blob(mask_id, file_storage.get_load_path(mask_id))
         
         return {
             "mask_id": mask_id,
@@ -77,20 +118,25 @@ async def upload_segmentation_mask(
 async def get_segmentation_mask(mask_id: str):
     """
     Get segmentation mask data in binary format.
+    
+    Voxel values are ``(label - X-Label-Min) / (X-Label-Max - X-Label-Min)``.
+    The range only changes when a patch adds labels outside it, and such
+    changes are announced in /segmentation/{mask_id}/changes.
     """
     try:
-        file_path = file_storage.get_file_path(mask_id)
+        file_path = file_storage.get_load_path(mask_id)
         if not file_path:
             raise HTTPException(status_code=404, detail=f"Mask {mask_id} not found")
         
         # Process mask (with caching)
-        binary_blob = processor.process_file(file_path, cache_key=mask_id)
+        binary_blob = _mask_blob(mask_id, file_path)
         
         return Response(
             content=binary_blob,
             media_type="application/octet-stream",
             headers={
-                "Content-Disposition": f'attachment; filename="mask_{mask_id}.bin"'
+                "Content-Disposition": f'attachment; filename="mask_{mask_id}.bin"',
+                **_label_headers(mask_id, file_path)
             }
         )
     except HTTPException:
@@ -98,3 +144,124 @@ async def get_segmentation_mask(mask_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing mask: {str(e)}")
 
+
+
+@router.patch("/segmentation/{mask_id}")
+async def patch_segmentation_mask(mask_id: str, patch: MaskPatch):
+    """
+    Apply sparse voxel or brick deltas to an existing mask.
+    
+    Each patch creates a new mask version. Viewers already holding the
+    mask can fetch just the deltas via /segmentation/{mask_id}/changes.
+    Bricks are applied first in the order given, then voxels; a repeated
+    voxel coordinate takes its last label. Labels outside the mask's
+    label range widen it for this and later versions.
+    """
+    try:
+        file_path = file_storage.get_load_path(mask_id)
+        if not file_path:
+            raise HTTPException(status_code=404, detail=f"Mask {mask_id} not found")
+        
+        current_version = mask_store.get_version(mask_id)
+        if patch.base_version is not None and patch.base_version != current_version:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Mask {mask_id} is at version {current_version}, not {patch.base_version}"
+            )
+        
+        bricks = [
+            {"origin": brick.origin, "shape": brick.shape, "labels": brick.labels}
+            for brick in patch.bricks
+        ]
+        result = mask_store.apply_patch(
+            mask_id, file_path, voxels=patch.voxels, bricks=bricks
+        )
+        
+        # Full downloads are rebuilt from the edited labels on next request
+        processor.evict(mask_id)
+        
+        return {
+            "mask_id": mask_id,
+            "version": result["version"],
+            "changed_voxels": result["changed_voxels"],
+            "label_range": result["label_range"]
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error patching mask: {str(e)}")
+
+
+@router.get("/segmentation/{mask_id}/changes")
+async def get_segmentation_changes(mask_id: str, since: int = 0):
+    """
+    Get the deltas applied to a mask after version ``since``.
+    
+    Apply the returned changes in order to reach the current version,
+    and within each change apply bricks before voxels. Labels are raw;
+    map them with ``label_range`` to match full downloads. A change that
+    carries its own ``label_range`` widened the scale: rescale from that
+    version on, or refetch the full mask.
+    """
+    try:
+        file_path = file_storage.get_load_path(mask_id)
+        if not file_path:
+            raise HTTPException(status_code=404, detail=f"Mask {mask_id} not found")
+        
+        changes = mask_store.get_changes_since(mask_id, since)
+        return {
+            "mask_id": mask_id,
+            "from_version": since,
+            "version": mask_store.get_version(mask_id),
+            "label_range": list(mask_store.get_label_range(mask_id, file_path)),
+            "changes": changes
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching mask changes: {str(e)}")
+
+
+@router.get("/segmentation/{mask_id}/versions")
+async def list_segmentation_versions(mask_id: str):
+    """
+    List the edit history of a mask.
+    """
+    try:
+        if not file_storage.get_load_path(mask_id):
+            raise HTTPException(status_code=404, detail=f"Mask {mask_id} not found")
+        
+        versions = mask_store.list_versions(mask_id)
+        return {
+            "mask_id": mask_id,
+            "version": mask_store.get_version(mask_id),
+            "versions": versions
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.delete("/segmentation/{mask_id}")
+async def delete_segmentation_mask(mask_id: str):
+    """
+    Delete a segmentation mask, its cached data and its edit history.
+    """
+    try:
+        processor.evict(mask_id)
+        mask_store.delete(mask_id)
+        
+        deleted = file_storage.delete_file(mask_id)
+        if not deleted:
+            raise HTTPException(status_code=404, detail=f"Mask {mask_id} not found")
+        
+        return {"message": f"Mask {mask_id} deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting mask: {str(e)}")
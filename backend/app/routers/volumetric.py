@@ -2,7 +2,7 @@
 Volumetric data endpoints for serving processed NIfTI files
 """
 from fastapi import APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from typing import Optional
 from app.services.volumetric_processor import VolumetricProcessor
 from app.services.file_storage import FileStorage
@@ -13,29 +13,46 @@ file_storage = FileStorage()
 
 
 @router.get("/volumetric/{file_id}")
-async def get_volumetric_data(file_id: str):
+async def get_volumetric_data(file_id: str, frame: int = 0):
     """
     Serve volumetric data in custom binary format with 40-byte header.
     
     Binary Format:
-    - Header (40 bytes): width, height, depth (uint32 each), data_type (uint32), reserved (28 bytes)
+    - Header (40 bytes): width, height, depth (uint32 each), data_type (uint32),
+      frame, frame_count (uint32 each), reserved (20 bytes)
     - Data: float32 array of normalized voxel values (0.0-1.0)
+    
+    Args:
+        frame: Frame index for 4D series (only this frame is decoded)
     """
     try:
         # Get file path from storage
-        file_path = file_storage.get_file_path(file_id)
+        file_path = file_storage.get_load_path(file_id)
         if not file_path:
             raise HTTPException(status_code=404, detail=f"File {file_id} not found")
         
+        frame_count = processor.get_series_info(file_path, cache_key=file_id)["frame_count"]
+        if not 0 <= frame < frame_count:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Frame {frame} out of range (file has {frame_count} frames)"
+            )
+        
         # Process file (with caching)
-        binary_blob = processor.process_file(file_path, cache_key=file_id)
+        binary_blob = processor.process_file(
+            file_path,
+            cache_key=file_id,
+            frame=frame,
+            value_range=file_storage.get_series_range(file_id)
+        )
         
         # Return binary response
         return Response(
             content=binary_blob,
             media_type="application/octet-stream",
             headers={
-                "Content-Disposition": f'attachment; filename="volume_{file_id}.bin"'
+                "Content-Disposition": f'attachment; filename="volume_{file_id}.bin"',
+                "X-Frame-Count": str(frame_count)
             }
         )
     except HTTPException:
@@ -44,6 +61,58 @@ async def get_volumetric_data(file_id: str):
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
 
+@router.get("/volumetric/{file_id}/frames")
+async def stream_volumetric_frames(file_id: str, start: int = 0, count: Optional[int] = None):
+    """
+    Stream consecutive frames of a 4D series for cine playback.
+    
+    The body is a concatenation of per-frame blobs, each in the same
+    format as GET /volumetric/{file_id}. Frames are decoded one at a time
+    and cached individually, so replaying a range is served from cache.
+    
+    Args:
+        start: First frame index to send
+        count: Number of frames to send (defaults to the rest of the series)
+    """
+    try:
+        file_path = file_storage.get_load_path(file_id)
+        if not file_path:
+            raise HTTPException(status_code=404, detail=f"File {file_id} not found")
+        
+        frame_count = processor.get_series_info(file_path, cache_key=file_id)["frame_count"]
+        if not 0 <= start < frame_count:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Frame {start} out of range (file has {frame_count} frames)"
+            )
+        if count is not None and count < 1:
+            raise HTTPException(status_code=400, detail="count must be at least 1")
+        
+        stop = frame_count if count is None else min(start + count, frame_count)
+        value_range = file_storage.get_series_range(file_id)
+        
+        def frame_blobs():
+            for frame in range(start, stop):
+                yield processor.process_file(
+                    file_path, cache_key=file_id, frame=frame, value_range=value_range
+                )
+        
+        return StreamingResponse(
+            frame_blobs(),
+            media_type="application/octet-stream",
+            headers={
+                "Content-Disposition": f'attachment; filename="frames_{file_id}.bin"',
+                "X-Frame-Count": str(frame_count),
+                "X-Frame-Start": str(start),
+                "X-Frame-Stop": str(stop)
+            }
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error streaming frames: {str(e)}")
+
+
 @router.post("/volumetric/upload")
 async def upload_volumetric_file(file: UploadFile = File(...)):
     """
@@ -68,9 +137,15 @@ async def upload_volumetric_file(file: UploadFile = File(...)):
         # Save file and get file_id
         file_id = file_storage.save_file(file_content, file.filename)
         
+        # Ingest: save the series-wide range so every frame shares one scale
+        file_path = file_storage.get_load_path(file_id)
+        if processor.get_series_info(file_path, cache_key=file_id)["frame_count"] > 1:
+            file_storage.save_series_range(file_id, processor.scan_series_range(file_path))
+        
         # Pre-process and cache the file
-        file_path = file_storage.get_file_path(file_id)
-        processor.process_file(file_path, cache_key=file_id)
+        processor.process_file(
+            file_path, cache_key=file_id, value_range=file_storage.get_series_range(file_id)
+        )
         
         return {
             "file_id": file_id,
@@ -101,9 +176,8 @@ async def delete_volumetric_file(file_id: str):
     Delete a volumetric file and its cached data
     """
     try:
-        # Remove from cache
-        if file_id in processor.data_cache:
-            del processor.data_cache[file_id]
+        # Remove all cached frames
+        processor.evict(file_id)
         
         # Delete file
         deleted = file_storage.delete_file(file_id)
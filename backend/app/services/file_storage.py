@@ -1,21 +1,34 @@
 """
 File storage service for managing uploaded NIfTI files
 """
+import gzip
+import json
 import os
 import uuid
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 import shutil
 
+# Copy buffer used when streaming a .nii.gz source into its raw layout
+TRANSCODE_CHUNK_SIZE = 1024 * 1024
+
 
 class FileStorage:
     """
     Manages storage and retrieval of uploaded NIfTI files.
+    
+    Compressed (.nii.gz) uploads are kept as received for export, and an
+    uncompressed .nii copy is written to raw/ at ingest time. nibabel can
+    memory-map the raw copy, so loads only read the bytes they slice.
+    Uploads from before transcoding existed are converted by
+    backfill_raw_copies(), which the app runs once in the background.
     """
     
     def __init__(self, storage_dir: str = "data/uploads"):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.raw_dir = self.storage_dir / "raw"
+        self.raw_dir.mkdir(parents=True, exist_ok=True)
         self.file_registry: Dict[str, Dict] = {}  # file_id -> metadata
         
         # Load existing files from disk on startup
@@ -24,7 +37,8 @@ class FileStorage:
     def _load_existing_files(self):
         """Load file registry from existing files in storage directory."""
         for file_path in self.storage_dir.glob("*.nii*"):
-            file_id = file_path.stem
+            extension = self._infer_extension(file_path.name)
+            file_id = file_path.name[:-len(extension)]
             if file_id not in self.file_registry:
                 self.file_registry[file_id] = {
                     "file_id": file_id,
@@ -32,6 +46,13 @@ class FileStorage:
                     "file_path": str(file_path),
                     "size": file_path.stat().st_size if file_path.exists() else 0
                 }
+                raw_path = self._raw_path(file_id)
+                if raw_path.exists():
+                    self.file_registry[file_id]["raw_path"] = str(raw_path)
+                range_path = self._series_range_path(file_id)
+                if range_path.exists():
+                    with open(range_path, 'r') as f:
+                        self.file_registry[file_id]["series_range"] = tuple(json.load(f))
     
     def _infer_extension(self, filename: str) -> str:
         """
@@ -45,6 +66,93 @@ class FileStorage:
             return suffixes[-1]
         return '.nii'
     
+    def _raw_path(self, file_id: str) -> Path:
+        """Location of the uncompressed, memory-mappable copy of a file."""
+        return self.raw_dir / f"{file_id}.nii"
+    
+    def _series_range_path(self, file_id: str) -> Path:
+        """Location of the saved value range of a 4D series."""
+        return self.raw_dir / f"{file_id}.range.json"
+    
+    def save_series_range(self, file_id: str, value_range: Tuple[float, float]) -> None:
+        """
+        Save the value range of a 4D series next to its raw copy.
+        
+        Args:
+            file_id: Unique file identifier
+            value_range: (min, max) over all frames
+        """
+        entry = self.file_registry.get(file_id)
+        if entry is None:
+            return
+        with open(self._series_range_path(file_id), 'w') as f:
+            json.dump(list(value_range), f)
+        entry["series_range"] = tuple(value_range)
+    
+    def get_series_range(self, file_id: str) -> Optional[Tuple[float, float]]:
+        """
+        Get the saved value range of a 4D series.
+        
+        Returns:
+            (min, max) if computed at ingest, None otherwise
+        """
+        entry = self.file_registry.get(file_id)
+        return entry.get("series_range") if entry else None
+    
+    def transcode_to_raw(self, file_id: str) -> Optional[str]:
+        """
+        Write an uncompressed .nii copy of a gzipped source.
+        
+        The gzip stream is decompressed in fixed-size chunks, so the whole
+        volume is never held in memory. The original file is left untouched.
+        
+        Args:
+            file_id: Unique file identifier
+            
+        Returns:
+            Path of the raw copy, or None if the file is unknown or not gzipped
+        """
+        entry = self.file_registry.get(file_id)
+        if entry is None or entry.get("transcode_failed"):
+            return None
+        
+        source_path = Path(entry["file_path"])
+        if self._infer_extension(source_path.name) != '.nii.gz':
+            return None
+        
+        raw_path = self._raw_path(file_id)
+        tmp_path = raw_path.with_suffix('.nii.tmp')
+        try:
+            with gzip.open(source_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, TRANSCODE_CHUNK_SIZE)
+            os.replace(tmp_path, raw_path)
+        except (OSError, EOFError):
+            # Not a valid gzip stream; keep serving the original and don't retry
+            if tmp_path.exists():
+                tmp_path.unlink()
+            entry["transcode_failed"] = True
+            return None
+        
+        entry["raw_path"] = str(raw_path)
+        return str(raw_path)
+    
+    def backfill_raw_copies(self) -> int:
+        """
+        Write raw copies for registered .nii.gz files that don't have one,
+        e.g. uploads from before ingest-time transcoding.
+        
+        Returns:
+            Number of raw copies written
+        """
+        written = 0
+        for file_id in list(self.file_registry):
+            entry = self.file_registry.get(file_id)
+            if entry is None or "raw_path" in entry:
+                continue
+            if self.transcode_to_raw(file_id):
+                written += 1
+        return written
+    
     def save_file(self, file_content: bytes, filename: str) -> str:
         """
         Save uploaded file and return unique file_id.
@@ -72,6 +180,9 @@ class FileStorage:
             "size": len(file_content)
         }
         
+        # Ingest: make compressed sources memory-mappable
+        self.transcode_to_raw(file_id)
+        
         return file_id
     
     def get_file_path(self, file_id: str) -> Optional[str]:
@@ -88,6 +199,32 @@ class FileStorage:
             return self.file_registry[file_id]["file_path"]
         return None
     
+    def get_load_path(self, file_id: str) -> Optional[str]:
+        """
+        Get the path that should be used for reading voxel data.
+        
+        Prefers the raw copy written at ingest, falling back to the
+        original upload when no raw copy exists.
+        
+        Args:
+            file_id: Unique file identifier
+            
+        Returns:
+            File path if exists, None otherwise
+        """
+        entry = self.file_registry.get(file_id)
+        if entry is None:
+            return None
+        
+        # Pick up raw copies written since this registry was loaded,
+        # e.g. by the startup backfill through another FileStorage
+        if "raw_path" not in entry and not entry.get("transcode_failed"):
+            raw_path = self._raw_path(file_id)
+            if self._infer_extension(entry["file_path"]) == '.nii.gz' and raw_path.exists():
+                entry["raw_path"] = str(raw_path)
+        
+        return entry.get("raw_path", entry["file_path"])
+    
     def list_files(self) -> list:
         """
         List all registered files.
@@ -114,6 +251,14 @@ class FileStorage:
         if file_path.exists():
             file_path.unlink()
         
+        raw_path = self.file_registry[file_id].get("raw_path")
+        if raw_path and Path(raw_path).exists():
+            Path(raw_path).unlink()
+        
+        range_path = self._series_range_path(file_id)
+        if range_path.exists():
+            range_path.unlink()
+        
         del self.file_registry[file_id]
         return True
 
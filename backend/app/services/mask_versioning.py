@@ -0,0 +1,368 @@
+"""
+Versioned segmentation masks for incremental edits
+Applies sparse voxel and brick deltas and keeps the per-version history
+"""
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+# Default label scale; covers the BraTS labels the viewer colors (0-4)
+MASK_LABEL_MAX = 4
+
+# Memory budget for label volumes kept for editing (least recently used go first)
+MASK_CACHE_BYTES = 256 * 1024 * 1024
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class MaskVersionStore:
+    """
+    Tracks the current labels and edit history of segmentation masks.
+
+    Version 0 is the mask as uploaded. Every applied patch creates a new
+    version holding only the voxels it changed, so clients can catch up
+    from any earlier version without downloading the whole volume.
+
+    Each mask's history is appended to ``{history_dir}/{mask_id}.jsonl``
+    (one delta per line) and read back on startup. Label volumes are only
+    built for PATCH, by replaying the history over the version 0 file, and
+    are kept in an LRU cache bounded by ``cache_bytes``.
+
+    Within a patch, bricks are applied first in the order given, then
+    voxels. Clients replaying deltas from /changes must use the same order.
+
+    Full downloads scale labels by the mask's label range: [0, MASK_LABEL_MAX]
+    widened to cover version 0. A patch with labels outside the range
+    widens it, and its delta carries the new ``label_range``.
+    """
+
+    def __init__(
+        self,
+        history_dir: str = "data/uploads/versions",
+        cache_bytes: int = MASK_CACHE_BYTES
+    ):
+        self.history_dir = Path(history_dir)
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        self.labels: OrderedDict = OrderedDict()  # mask_id -> current label volume, LRU order
+        self.cache_bytes = cache_bytes
+        self.cache_size = 0
+        self.base_ranges: Dict[str, Tuple[int, int]] = {}  # mask_id -> label range of version 0
+        self.history: Dict[str, List[Dict]] = {}  # mask_id -> list of deltas, index i = version i + 1
+
+        # Load edit histories saved before a restart
+        self._load_histories()
+
+    def _history_path(self, mask_id: str) -> Path:
+        """Location of a mask's persisted edit history."""
+        return self.history_dir / f"{mask_id}.jsonl"
+
+    def _load_histories(self):
+        """Load edit histories from existing files in the history directory."""
+        for history_path in self.history_dir.glob("*.jsonl"):
+            deltas = []
+            valid_bytes = 0
+            with open(history_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        deltas.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+                    valid_bytes += len(line)
+
+            # Drop a partially written last line from an interrupted save,
+            # so the next append starts on a fresh line
+            if valid_bytes < history_path.stat().st_size:
+                with open(history_path, 'r+b') as f:
+                    f.truncate(valid_bytes)
+
+            self.history[history_path.stem] = deltas
+
+    def _load_base(self, mask_id: str, file_path: str) -> np.ndarray:
+        """Load version 0 labels from disk and record its label range."""
+        from app.services.nifti_loader import load_nifti_file
+        data, _ = load_nifti_file(file_path)
+        labels = np.rint(data).astype(np.int32)
+        if mask_id not in self.base_ranges:
+            self.base_ranges[mask_id] = (
+                min(int(labels.min()), 0),
+                max(int(labels.max()), MASK_LABEL_MAX)
+            )
+        return labels
+
+    def _build_labels(self, mask_id: str, file_path: str) -> np.ndarray:
+        """Current labels: version 0 with the saved history replayed on top."""
+        labels = self._load_base(mask_id, file_path)
+        for delta in self.history.get(mask_id, []):
+            self._apply_delta(labels, delta)
+        return labels
+
+    def load(self, mask_id: str, file_path: str) -> np.ndarray:
+        """
+        Return the current labels for editing, keeping them in the LRU cache.
+
+        Args:
+            mask_id: Mask identifier
+            file_path: Path to the mask file (version 0)
+
+        Returns:
+            Current label volume (int32)
+        """
+        if mask_id in self.labels:
+            self.labels.move_to_end(mask_id)
+            return self.labels[mask_id]
+
+        labels = self._build_labels(mask_id, file_path)
+        self.history.setdefault(mask_id, [])
+        self.labels[mask_id] = labels
+        self.cache_size += labels.nbytes
+        while self.cache_size > self.cache_bytes and len(self.labels) > 1:
+            _, evicted = self.labels.popitem(last=False)
+            self.cache_size -= evicted.nbytes
+        return labels
+
+    def render(self, mask_id: str, file_path: str) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Current labels and label range for a full download.
+
+        Unlike load(), a mask that isn't being edited is not cached here;
+        the caller caches the processed blob instead.
+
+        Returns:
+            Tuple of (label volume, (min, max) label range)
+        """
+        if mask_id in self.labels:
+            labels = self.labels[mask_id]
+        else:
+            labels = self._build_labels(mask_id, file_path)
+        return labels, self.get_label_range(mask_id, file_path)
+
+    def evict(self, mask_id: str) -> None:
+        """Drop a mask's cached labels; its history is kept."""
+        labels = self.labels.pop(mask_id, None)
+        if labels is not None:
+            self.cache_size -= labels.nbytes
+
+    def delete(self, mask_id: str) -> None:
+        """Drop a mask's labels and delete its saved history."""
+        self.evict(mask_id)
+        self.base_ranges.pop(mask_id, None)
+        self.history.pop(mask_id, None)
+        history_path = self._history_path(mask_id)
+        if history_path.exists():
+            history_path.unlink()
+
+    def get_version(self, mask_id: str) -> int:
+        """Current version of a mask (0 if it has never been patched)."""
+        return len(self.history.get(mask_id, []))
+
+    def get_label_range(self, mask_id: str, file_path: str) -> Tuple[int, int]:
+        """
+        Current (min, max) label scale of a mask.
+
+        Full downloads serve ``(label - min) / (max - min)``, so clients
+        can map raw labels from /changes onto the same scale.
+        """
+        for delta in reversed(self.history.get(mask_id, [])):
+            if "label_range" in delta:
+                return tuple(delta["label_range"])
+        if mask_id not in self.base_ranges:
+            self._load_base(mask_id, file_path)
+        return self.base_ranges[mask_id]
+
+    def apply_patch(
+        self,
+        mask_id: str,
+        file_path: str,
+        voxels: Sequence[Sequence[int]] = (),
+        bricks: Sequence[Dict] = ()
+    ) -> Dict:
+        """
+        Apply voxel and brick deltas to a mask and record a new version.
+
+        Bricks are applied first in the order given, then voxels. When a
+        voxel coordinate appears more than once, the last entry wins.
+
+        Args:
+            mask_id: Mask identifier
+            file_path: Path to the mask file, used to load version 0
+            voxels: Sparse edits as [x, y, z, label] entries
+            bricks: Dense edits as {"origin": [x, y, z], "shape": [a, b, c],
+                    "labels": flat C-order list of a * b * c labels}
+
+        Returns:
+            Summary with the new version, the number of voxels whose label
+            differs from the previous version, and the label range
+        """
+        labels = self.load(mask_id, file_path)
+
+        # Validate everything before touching the volume so a bad delta
+        # leaves the mask unchanged
+        voxel_delta = self._validate_voxels(voxels, labels.shape)
+        brick_deltas = [self._validate_brick(brick, labels.shape) for brick in bricks]
+        if voxel_delta is None and not brick_deltas:
+            raise ValueError("Patch contains no voxel or brick deltas")
+
+        delta = {
+            "voxels": [] if voxel_delta is None else np.column_stack(voxel_delta).tolist(),
+            "bricks": [
+                {
+                    "origin": list(origin),
+                    "shape": list(values.shape),
+                    "labels": values.ravel(order='C').tolist()
+                }
+                for origin, values in brick_deltas
+            ]
+        }
+
+        # Widen the label scale if the patch adds labels outside it
+        label_min, label_max = self.get_label_range(mask_id, file_path)
+        new_values = [values.ravel() for _, values in brick_deltas]
+        if voxel_delta is not None:
+            new_values.append(voxel_delta[1])
+        new_values = np.concatenate(new_values)
+        new_range = (
+            min(label_min, int(new_values.min())),
+            max(label_max, int(new_values.max()))
+        )
+        if new_range != (label_min, label_max):
+            delta["label_range"] = list(new_range)
+
+        # Snapshot the touched voxels so overlapping edits are counted once
+        touched, before = [], []
+        for origin, values in brick_deltas:
+            region = tuple(slice(o, o + s) for o, s in zip(origin, values.shape))
+            coords = np.indices(values.shape).reshape(3, -1) + np.asarray(origin)[:, None]
+            touched.append(np.ravel_multi_index(tuple(coords), labels.shape))
+            before.append(labels[region].ravel(order='C').copy())
+        if voxel_delta is not None:
+            index = tuple(voxel_delta[0].T)
+            touched.append(np.ravel_multi_index(index, labels.shape))
+            before.append(labels[index].copy())
+
+        self._apply_delta(labels, delta)
+
+        touched_flat, first = np.unique(np.concatenate(touched), return_index=True)
+        changed_voxels = int(
+            (labels.reshape(-1)[touched_flat] != np.concatenate(before)[first]).sum()
+        )
+        delta["changed_voxels"] = changed_voxels
+
+        # Persist durably before publishing the new version
+        try:
+            with open(self._history_path(mask_id), 'a') as f:
+                f.write(json.dumps(delta) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            # Rebuild from the saved history on next use
+            self.evict(mask_id)
+            raise
+        self.history[mask_id].append(delta)
+
+        return {
+            "version": self.get_version(mask_id),
+            "changed_voxels": changed_voxels,
+            "label_range": list(new_range)
+        }
+
+    def get_changes_since(self, mask_id: str, since: int) -> List[Dict]:
+        """
+        Deltas needed to bring a client from version ``since`` to current.
+
+        A change that carries ``label_range`` widened the label scale;
+        clients must rescale (or refetch the full mask) from that version on.
+
+        Args:
+            mask_id: Mask identifier
+            since: Version the client currently has
+
+        Returns:
+            Ordered list of deltas, each tagged with the version it creates
+        """
+        current = self.get_version(mask_id)
+        if not 0 <= since <= current:
+            raise ValueError(f"Version {since} out of range (current version is {current})")
+
+        changes = []
+        for index, delta in enumerate(self.history.get(mask_id, [])[since:], start=since + 1):
+            change = {
+                "version": index,
+                "voxels": delta["voxels"],
+                "bricks": delta["bricks"]
+            }
+            if "label_range" in delta:
+                change["label_range"] = delta["label_range"]
+            changes.append(change)
+        return changes
+
+    def list_versions(self, mask_id: str) -> List[Dict]:
+        """Per-version summary of a mask's edit history."""
+        return [
+            {
+                "version": index,
+                "voxel_count": len(delta["voxels"]),
+                "brick_count": len(delta["bricks"]),
+                "changed_voxels": delta["changed_voxels"],
+                "label_range_changed": "label_range" in delta
+            }
+            for index, delta in enumerate(self.history.get(mask_id, []), start=1)
+        ]
+
+    def _apply_delta(self, labels: np.ndarray, delta: Dict):
+        """Write one recorded delta into a label volume: bricks, then voxels."""
+        for brick in delta["bricks"]:
+            region = tuple(slice(o, o + s) for o, s in zip(brick["origin"], brick["shape"]))
+            labels[region] = np.asarray(brick["labels"], dtype=np.int32).reshape(brick["shape"])
+        if delta["voxels"]:
+            entries = np.asarray(delta["voxels"], dtype=np.int64)
+            labels[tuple(entries[:, :3].T)] = entries[:, 3]
+
+    def _check_labels(self, values: np.ndarray):
+        """Reject labels that don't fit the int32 label volume."""
+        if values.size and (values.min() < INT32_MIN or values.max() > INT32_MAX):
+            raise ValueError(f"Labels must be within [{INT32_MIN}, {INT32_MAX}]")
+
+    def _validate_voxels(self, voxels: Sequence[Sequence[int]], shape: tuple):
+        """Convert [x, y, z, label] entries to deduplicated (coords, labels) arrays."""
+        if len(voxels) == 0:
+            return None
+        try:
+            entries = np.asarray(voxels, dtype=np.int64)
+        except (OverflowError, ValueError):
+            raise ValueError("Voxel deltas must be [x, y, z, label] integer entries")
+        if entries.ndim != 2 or entries.shape[1] != 4:
+            raise ValueError("Voxel deltas must be [x, y, z, label] entries")
+        coords = entries[:, :3]
+        if (coords < 0).any() or (coords >= np.asarray(shape)).any():
+            raise ValueError(f"Voxel delta outside mask bounds {shape}")
+        self._check_labels(entries[:, 3])
+
+        # Last write wins for repeated coordinates; keep the original order
+        flat = np.ravel_multi_index(tuple(coords.T), shape)
+        _, last_reversed = np.unique(flat[::-1], return_index=True)
+        keep = np.sort(len(flat) - 1 - last_reversed)
+        return coords[keep], entries[keep, 3].astype(np.int32)
+
+    def _validate_brick(self, brick: Dict, shape: tuple):
+        """Convert a brick delta to (origin, labels array)."""
+        origin = list(brick["origin"])
+        size = list(brick["shape"])
+        if len(origin) != 3 or len(size) != 3:
+            raise ValueError("Brick deltas need a 3D origin and shape")
+        if any(s < 1 for s in size):
+            raise ValueError(f"Brick shape {size} must be positive")
+        if any(o < 0 or o + s > d for o, s, d in zip(origin, size, shape)):
+            raise ValueError(f"Brick at {origin} with shape {size} outside mask bounds {shape}")
+        try:
+            values = np.asarray(brick["labels"], dtype=np.int64)
+        except OverflowError:
+            raise ValueError(f"Labels must be within [{INT32_MIN}, {INT32_MAX}]")
+        if values.size != size[0] * size[1] * size[2]:
+            raise ValueError(f"Brick labels must contain {size[0] * size[1] * size[2]} values")
+        self._check_labels(values)
+        return tuple(origin), values.astype(np.int32).reshape(size, order='C')
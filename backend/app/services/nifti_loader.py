@@ -4,35 +4,112 @@ This module handles loading .nii and .nii.gz files
 """
 import nibabel as nib
 import numpy as np
-from typing import Tuple
+from typing import Optional, Tuple
 
 
-def load_nifti_file(file_path: str) -> Tuple[np.ndarray, Tuple[int, int, int]]:
+def load_nifti_file(
+    file_path: str,
+    roi: Optional[Tuple[slice, ...]] = None,
+    frame: int = 0
+) -> Tuple[np.ndarray, Tuple[int, int, int]]:
     """
     Load a NIfTI file and return the data array and dimensions.
     
+    Voxels are read through the image's array proxy, so for uncompressed
+    .nii files only the bytes covered by ``roi`` are read from disk. For
+    4D series only the requested frame is decoded.
+    
     Args:
         file_path: Path to .nii or .nii.gz file
+        roi: Optional index (e.g. tuple of slices) over the spatial axes
+        frame: Frame (4th axis) index to load for 4D series
         
     Returns:
         Tuple of (data_array, (width, height, depth))
         Note: NIfTI dimensions may need axis reordering depending on orientation
     """
     try:
-        img = nib.load(file_path)
-        data = img.get_fdata()
+        img = nib.load(file_path, mmap=True)
+        proxy = img.dataobj
+        
+        if roi is None:
+            roi = ()
+        elif not isinstance(roi, tuple):
+            roi = (roi,)
+        
+        # If 4D (with time/channel dimension), slice out a single volume
+        # through the proxy instead of decoding the whole series
+        if len(img.shape) == 4:
+            spatial = roi + (slice(None),) * (3 - len(roi))
+            data = proxy[spatial + (frame,)]
+        else:
+            data = proxy[roi] if roi else proxy
+        
+        data = np.asarray(data, dtype=np.float64)
         
         # Get dimensions - NIfTI uses (x, y, z) convention typically
         # But numpy arrays are indexed as (z, y, x) or (y, x, z) depending on orientation
         # For now, we'll use the raw shape and let the processor handle it
         shape = data.shape
         
-        # If 4D (with time/channel dimension), take first volume
-        if len(shape) == 4:
-            data = data[:, :, :, 0]
-            shape = data.shape
-        
         return data, shape
     except Exception as e:
         raise ValueError(f"Failed to load NIfTI file {file_path}: {str(e)}")
 
+
+def read_series_header(file_path: str) -> Tuple[int, Optional[Tuple[float, float]]]:
+    """
+    Get the frame count and display range of a NIfTI file from its header.
+    
+    No voxel data is read.
+    
+    Args:
+        file_path: Path to .nii or .nii.gz file
+        
+    Returns:
+        Tuple of (frame_count, (cal_min, cal_max)); the range is None when
+        the header doesn't set a valid cal_min/cal_max
+    """
+    try:
+        img = nib.load(file_path, mmap=True)
+        shape = img.shape
+        frame_count = shape[3] if len(shape) == 4 else 1
+        
+        cal_min = float(img.header["cal_min"])
+        cal_max = float(img.header["cal_max"])
+        value_range = (cal_min, cal_max) if cal_max > cal_min else None
+        return frame_count, value_range
+    except Exception as e:
+        raise ValueError(f"Failed to read NIfTI header {file_path}: {str(e)}")
+
+
+def scan_series_range(file_path: str) -> Tuple[float, float]:
+    """
+    Compute the value range of a whole NIfTI series.
+    
+    The range is computed in one pass over the array proxy, decoding a
+    single frame at a time. The file handle is kept open so a .nii.gz
+    stream is read once, not restarted for each frame. NaN and infinite
+    values count as 0, matching the processor's normalize. Meant for
+    ingest, not request paths.
+    
+    Args:
+        file_path: Path to .nii or .nii.gz file
+        
+    Returns:
+        (min, max) over all voxels of all frames
+    """
+    try:
+        img = nib.load(file_path, mmap=True, keep_file_open=True)
+        frame_count = img.shape[3] if len(img.shape) == 4 else 1
+        data_min, data_max = np.inf, -np.inf
+        for frame in range(frame_count):
+            data = img.dataobj[..., frame] if len(img.shape) == 4 else img.dataobj
+            data = np.nan_to_num(
+                np.asarray(data, dtype=np.float64), nan=0.0, posinf=0.0, neginf=0.0
+            )
+            data_min = min(data_min, float(data.min()))
+            data_max = max(data_max, float(data.max()))
+        return data_min, data_max
+    except Exception as e:
+        raise ValueError(f"Failed to scan NIfTI file {file_path}: {str(e)}")
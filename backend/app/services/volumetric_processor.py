@@ -3,9 +3,14 @@ Volumetric data processor for NIfTI files
 Handles normalization, binary packing, and custom protocol generation
 """
 import numpy as np
-from typing import Tuple, Optional
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Tuple, Optional
 import struct
 
+# Memory budget for cached frames of 4D series (least recently used go first)
+FRAME_CACHE_BYTES = 256 * 1024 * 1024
+
 
 class VolumetricProcessor:
     """
@@ -15,31 +20,100 @@ class VolumetricProcessor:
     1. Load NIfTI file
     2. Normalize intensity values to 0.0-1.0
     3. Pack into binary format with 40-byte header
+    
+    3D volumes are cached in ``data_cache``. Frames of 4D series go into a
+    separate LRU cache bounded by ``frame_cache_bytes``, so cine playback
+    does not keep the whole series in memory.
     """
     
-    def __init__(self):
+    def __init__(self, frame_cache_bytes: int = FRAME_CACHE_BYTES):
         self.data_cache = {}  # Cache processed volumes (file_id -> binary_blob)
+        self.frame_cache: OrderedDict = OrderedDict()  # (file_id, frame) -> binary_blob, LRU order
+        self.frame_cache_bytes = frame_cache_bytes
+        self.frame_cache_size = 0
+        self.series_info: Dict[str, Dict] = {}  # file_id -> frame_count and header value range
+        self._frame_lock = Lock()
+    
+    def _get_cached_frame(self, key: Tuple[str, int]) -> Optional[bytes]:
+        """Look up a cached frame and mark it as most recently used."""
+        with self._frame_lock:
+            blob = self.frame_cache.get(key)
+            if blob is not None:
+                self.frame_cache.move_to_end(key)
+            return blob
     
-    def load_nifti(self, file_path: str) -> np.ndarray:
+    def _cache_frame(self, key: Tuple[str, int], blob: bytes) -> None:
+        """Store a frame, evicting least recently used frames over budget."""
+        with self._frame_lock:
+            if key in self.frame_cache:
+                self.frame_cache_size -= len(self.frame_cache.pop(key))
+            self.frame_cache[key] = blob
+            self.frame_cache_size += len(blob)
+            while self.frame_cache_size > self.frame_cache_bytes and len(self.frame_cache) > 1:
+                _, evicted = self.frame_cache.popitem(last=False)
+                self.frame_cache_size -= len(evicted)
+    
+    def load_nifti(self, file_path: str, frame: int = 0) -> np.ndarray:
         """
         Load a NIfTI file and return as numpy array.
         
         Args:
             file_path: Path to .nii or .nii.gz file
+            frame: Frame index to load for 4D series
             
         Returns:
             3D numpy array of voxel data
         """
         from app.services.nifti_loader import load_nifti_file
-        data, _ = load_nifti_file(file_path)
+        data, _ = load_nifti_file(file_path, frame=frame)
         return data
     
-    def normalize(self, data: np.ndarray) -> np.ndarray:
+    def get_series_info(self, file_path: str, cache_key: Optional[str] = None) -> Dict:
+        """
+        Get the frame count and header display range of a NIfTI file.
+        
+        Only the header is read, once per cache key.
+        
+        Args:
+            file_path: Path to .nii or .nii.gz file
+            cache_key: Optional cache key to store/retrieve the info
+            
+        Returns:
+            Dict with "frame_count" and "range" ((cal_min, cal_max), or None)
+        """
+        if cache_key and cache_key in self.series_info:
+            return self.series_info[cache_key]
+        
+        from app.services.nifti_loader import read_series_header
+        frame_count, value_range = read_series_header(file_path)
+        info = {"frame_count": frame_count, "range": value_range}
+        
+        if cache_key:
+            self.series_info[cache_key] = info
+        return info
+    
+    def scan_series_range(self, file_path: str) -> Tuple[float, float]:
+        """
+        Compute the value range of a whole series, one frame at a time.
+        
+        This reads every frame, so call it at ingest rather than per request.
+        """
+        from app.services.nifti_loader import scan_series_range
+        return scan_series_range(file_path)
+    
+    def normalize(
+        self,
+        data: np.ndarray,
+        value_range: Optional[Tuple[float, float]] = None
+    ) -> np.ndarray:
         """
         Normalize voxel intensities to 0.0-1.0 range.
         
         Args:
             data: Raw voxel data from MRI scanner
+            value_range: Optional fixed (min, max) to scale by instead of
+                the array's own range, e.g. for all frames of a series.
+                Values outside it are clipped.
             
         Returns:
             Normalized array (float32, 0.0-1.0)
@@ -48,17 +122,22 @@ class VolumetricProcessor:
         data = np.nan_to_num(data, nan=0.0, posinf=0.0, neginf=0.0)
         
         # Normalize to 0-1 range
-        data_min = np.min(data)
-        data_max = np.max(data)
+        if value_range is not None:
+            data_min, data_max = value_range
+        else:
+            data_min = np.min(data)
+            data_max = np.max(data)
         
         if data_max > data_min:
             normalized = (data - data_min) / (data_max - data_min)
+            if value_range is not None:
+                normalized = np.clip(normalized, 0.0, 1.0)
         else:
             normalized = np.zeros_like(data)
         
         return normalized.astype(np.float32)
     
-    def pack_binary(self, data: np.ndarray) -> bytes:
+    def pack_binary(self, data: np.ndarray, frame: int = 0, frame_count: int = 1) -> bytes:
         """
         Pack normalized 3D array into custom binary format.
         
@@ -68,7 +147,9 @@ class VolumetricProcessor:
           * height (uint32, 4 bytes)
           * depth (uint32, 4 bytes)
           * data_type (uint32, 4 bytes) - 1 = float32
-          * reserved (28 bytes, zeros)
+          * frame (uint32, 4 bytes) - frame index within a 4D series
+          * frame_count (uint32, 4 bytes) - number of frames in the series
+          * reserved (20 bytes, zeros)
         - Data: float32 array (width * height * depth * 4 bytes)
         
         Note: NIfTI arrays are typically (x, y, z) or (z, y, x) depending on orientation.
@@ -76,6 +157,8 @@ class VolumetricProcessor:
         
         Args:
             data: Normalized 3D array (float32) - shape is (dim0, dim1, dim2)
+            frame: Frame index of this volume
+            frame_count: Total number of frames in the source series
             
         Returns:
             Binary blob ready for transmission
@@ -91,11 +174,13 @@ class VolumetricProcessor:
         
         # Create 40-byte header
         header = struct.pack(
-            '>IIII',  # Big-endian uint32 for each dimension
+            '>IIIIII',  # Big-endian uint32 for each dimension
             width,
             height,
             depth,
-            1  # data_type: 1 = float32
+            1,  # data_type: 1 = float32
+            frame,
+            frame_count
         )
         # Pad header to 40 bytes
         header += b'\x00' * (40 - len(header))
@@ -107,36 +192,97 @@ class VolumetricProcessor:
         
         return header + data_bytes
     
-    def process_file(self, file_path: str, cache_key: Optional[str] = None) -> bytes:
+    def process_file(
+        self,
+        file_path: str,
+        cache_key: Optional[str] = None,
+        frame: int = 0,
+        value_range: Optional[Tuple[float, float]] = None
+    ) -> bytes:
         """
         Complete processing pipeline: load -> normalize -> pack.
         
+        For 4D series only the requested frame is loaded. Frames are scaled
+        by ``value_range`` (the series range saved at ingest), else by the
+        header's cal_min/cal_max, else each frame by its own range. 3D
+        volumes use their own range unless ``value_range`` is given. Frames
+        are kept in the bounded LRU frame cache.
+        
         Args:
             file_path: Path to NIfTI file
             cache_key: Optional cache key to store/retrieve processed data
+            frame: Frame index to process for 4D series
+            value_range: Optional fixed (min, max) to normalize by
             
         Returns:
             Binary blob in custom format
         """
         # Check cache first
-        if cache_key and cache_key in self.data_cache:
-            return self.data_cache[cache_key]
+        if cache_key:
+            if cache_key in self.data_cache:
+                return self.data_cache[cache_key]
+            cached_frame = self._get_cached_frame((cache_key, frame))
+            if cached_frame is not None:
+                return cached_frame
         
         # Load
-        raw_data = self.load_nifti(file_path)
+        info = self.get_series_info(file_path, cache_key=cache_key)
+        raw_data = self.load_nifti(file_path, frame=frame)
         
         # Normalize
-        normalized = self.normalize(raw_data)
+        if info["frame_count"] > 1 and value_range is None:
+            value_range = info["range"]
+        normalized = self.normalize(raw_data, value_range=value_range)
         
         # Pack
-        binary_blob = self.pack_binary(normalized)
+        binary_blob = self.pack_binary(
+            normalized, frame=frame, frame_count=info["frame_count"]
+        )
         
         # Cache if key provided
         if cache_key:
-            self.data_cache[cache_key] = binary_blob
+            if info["frame_count"] > 1:
+                self._cache_frame((cache_key, frame), binary_blob)
+            else:
+                self.data_cache[cache_key] = binary_blob
+        
+        return binary_blob
+    
+    def process_array(
+        self,
+        data: np.ndarray,
+        cache_key: Optional[str] = None,
+        value_range: Optional[Tuple[float, float]] = None
+    ) -> bytes:
+        """
+        Normalize and pack an in-memory volume, replacing any cached blob.
         
+        Args:
+            data: 3D voxel array
+            cache_key: Optional cache key to store the processed data under
+            value_range: Optional fixed (min, max) to scale by
+            
+        Returns:
+            Binary blob in custom format
+        """
+        binary_blob = self.pack_binary(self.normalize(data, value_range=value_range))
+        if cache_key:
+            self.data_cache[cache_key] = binary_blob
         return binary_blob
     
+    def evict(self, cache_key: str) -> None:
+        """
+        Remove every cached volume, frame and series info for a cache key.
+        
+        Args:
+            cache_key: Cache key used when processing the file
+        """
+        self.data_cache.pop(cache_key, None)
+        self.series_info.pop(cache_key, None)
+        with self._frame_lock:
+            for key in [key for key in self.frame_cache if key[0] == cache_key]:
+                self.frame_cache_size -= len(self.frame_cache.pop(key))
+    
     def get_dimensions(self, file_path: str) -> Tuple[int, int, int]:
         """
         Get dimensions of a NIfTI file without full processing.